@@ -22,6 +22,7 @@ from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.network.netvisor.pn_netvisor import *
 import ipaddress
 import itertools as it
+import re
 
 
 # Calculate ip address using ipaddress module for all subnets
@@ -158,38 +159,40 @@ msg:
 """
 
 
-class BetterIPv4Network(ipaddress.IPv4Network):
-
-    def __add__(self, offset):
-        """Add numeric offset to the IP."""
-        new_base_addr = int(self.network_address) + offset
-        return self.__class__((new_base_addr, str(self.netmask)))
-
-    def size(self):
-        """Return network size."""
-        start = int(self.network_address)
-        return int(self.broadcast_address) + 1 - start
+def finding_initial_ip(base_int, size, count):
+    """
+    Method to find the intial ip of the ipv4 addressing scheme.
+    :param base_int: Network address of ip addressing scheme as integer.
+    :param size: Number of addresses in each link subnet.
+    :param count: Index of the link subnet.
+    :return: ip addresses pair as integers.
+    """
+    # Jump straight to the count'th subnet instead of walking every
+    # subnet before it. /31 has no network/broadcast address.
+    base = base_int + count * size
+    first = base if size <= 2 else base + 1
+    return first, first + 1
 
 
-def finding_initial_ip(module, start_ip, subnet_ipv4, count):
+def fail_json_summary(module, msg):
     """
-    Method to find the intial ip of the ipv4 addressing scheme.
+    Method to exit the module with a failure summary.
     :param module: The Ansible module to fetch input parameters.
-    :param state_ip: start ip of ip addressing scheme.
-    :param subnet_ipv4: Subnet to calculate ip address list.
-    :return: ip addresses list.
+    :param msg: Error message describing the failure.
     """
-    if  count == 0:
-        ips = list(ipaddress.ip_network(start_ip +'/'+subnet_ipv4).hosts())
-        return ips
-    else:
-        network = BetterIPv4Network(start_ip + '/' + subnet_ipv4)
-        network_addrs = (network + (i + 1) * network.size() for i in it.count())
-        for c in range(count):
-            my_range = network_addrs.next()
-            ips = list(ipaddress.ip_network(my_range).hosts())
-
-        return ips
+    results = {
+        'switch': '',
+        'output': msg
+    }
+    module.exit_json(
+        unreachable=False,
+        failed=True,
+        exception=msg,
+        summary=results,
+        task='L3 ZTP',
+        msg='L3 ZTP failed',
+        changed=False
+    )
 
 
 def auto_configure_link_ips(module, CHANGED_FLAG, task, msg):
@@ -198,106 +201,107 @@ def auto_configure_link_ips(module, CHANGED_FLAG, task, msg):
     :param module: The Ansible module to fetch input parameters.
     :return: String describing output of configuration.
     """
-    spine_list = module.params['pn_spine_list']
-    leaf_list = module.params['pn_leaf_list']
-    addr_type = module.params['pn_addr_type']
-    start_ip = unicode(module.params['pn_ipv4_start_address'], "utf-8")
-    if addr_type == 'ipv4' or addr_type == 'ipv4_ipv6':
-        subnet_ipv4 = unicode(module.params['pn_subnet_ipv4'], "utf-8")
-    if addr_type == 'ipv6' or addr_type == 'ipv4_ipv6':
-        subnet_ipv6 = module.params['pn_subnet_ipv6']
-    current_switch = module.params['pn_current_switch']
-    output = ''
+    params = module.params
+    spine_list = params['pn_spine_list']
+    leaf_list = params['pn_leaf_list']
+    addr_type = params['pn_addr_type']
+    do_v4 = addr_type in ('ipv4', 'ipv4_ipv6')
+    do_v6 = addr_type in ('ipv6', 'ipv4_ipv6')
+    start_ip = params['pn_ipv4_start_address']
+    if do_v4:
+        subnet_ipv4 = params['pn_subnet_ipv4']
+    if do_v6:
+        subnet_ipv6 = params['pn_subnet_ipv6']
+        ipv6_127 = subnet_ipv6 == '127'
+    current_switch = params['pn_current_switch']
+    output = []
 
     cli = pn_cli(module)
     clicopy = cli
 
     if current_switch in leaf_list:
-        # Disable auto trunk on all switches.
-        modify_auto_trunk_setting(module, current_switch, 'disable', task, msg)
-        for spine in spine_list:
-            # Disable auto trunk.
-            modify_auto_trunk_setting(module, spine, 'disable', task, msg)
-
-        # Get the list of available link ips to assign.
-        if addr_type == 'ipv6' or addr_type == 'ipv4_ipv6':
-            get_count = 2 if subnet_ipv6 == '127' else 3
-            available_ips_ipv6 = calculate_link_ip_addresses_ipv6(module.params['pn_net_address_ipv6'],
-                                                                  module.params['pn_cidr_ipv6'],
-                                                                  subnet_ipv6, get_count)
-            for i in range(count_output):
-                available_ips_ipv6.next()
-
+        # Links used by the leafs before this one, one per leaf/spine pair.
         count = leaf_list.index(current_switch) * len(spine_list)
-        for spine in spine_list:
-            ips = finding_initial_ip(module, start_ip, subnet_ipv4, count)
-            cli = clicopy
-            cli += ' switch %s port-show hostname %s ' % (current_switch, spine)
-            cli += ' format port no-show-headers '
-            leaf_port = run_command(module, cli, task, msg).split()
-            leaf_port = list(set(leaf_port))
 
-            if 'Success' in leaf_port:
-                continue
-
-            while len(leaf_port) > 0:
+        # Get the IPv6 link ips of every spine up front, skipping the ones
+        # already used without stepping through them one by one.
+        if do_v6:
+            get_count = 2 if ipv6_127 else 3
+            available_ips_ipv6 = calculate_link_ip_addresses_ipv6(params['pn_net_address_ipv6'],
+                                                                  params['pn_cidr_ipv6'],
+                                                                  subnet_ipv6, get_count)
+            ipv6_links = list(it.islice(available_ips_ipv6, count, count + len(spine_list)))
+            if len(ipv6_links) < len(spine_list):
+                fail_json_summary(module, 'Error: ipv6 range exhausted')
+
+        # Work out the IPv4 link subnet of every spine up front.
+        if do_v4:
+            try:
+                network = ipaddress.IPv4Network(start_ip + '/' + subnet_ipv4)
+            except ValueError as error:
+                fail_json_summary(module, 'Error: invalid ipv4 link network: %s' % error)
+            base_int = int(network.network_address)
+            size = network.num_addresses
+            if size < 2:
+                fail_json_summary(module, 'Error: ipv4 subnet /%s is too small for link ips' % subnet_ipv4)
+            link_ips = [finding_initial_ip(base_int, size, count + i)
+                        for i in range(len(spine_list))]
+
+        # Disable auto trunk on all switches with a single CLI call.
+        trunk_switches = ','.join([current_switch] + spine_list)
+        modify_auto_trunk_setting(module, trunk_switches, 'disable', task, msg)
+
+        port_show_cli = clicopy + ' switch %s port-show hostname ' % current_switch
+
+        # Map each leaf port to its spine port, one query per spine.
+        spine_ports = []
+        for spine in spine_list:
+            cli = port_show_cli + spine + ' format port,rport no-show-headers '
+            port_output = run_command(module, cli, task, msg)
+
+            port_map = {}
+            if 'Success' not in port_output.split():
+                for line in port_output.splitlines():
+                    fields = line.split()
+                    if len(fields) == 2:
+                        port_map.setdefault(fields[0], fields[1])
+
+            # IPv6 link ips are allotted per leaf/spine pair, a second
+            # port to the same spine would reuse another leaf's addresses.
+            if do_v6 and len(port_map) > 1:
+                fail_json_summary(module, 'Error: multiple links between %s and %s '
+                                          'are not supported for ipv6' % (current_switch, spine))
+            spine_ports.append(port_map)
+
+        for spine_index, spine in enumerate(spine_list):
+            for lport, rport in spine_ports[spine_index].items():
                 ip_ipv6 = ''
                 ip_ipv4 = ''
-                if addr_type == 'ipv6' or addr_type == 'ipv4_ipv6':
-                    try:
-                        ip_list = available_ips_ipv6.next()
-                    except:
-                        msg = 'Error: ipv6 range exhausted'
-                        results = {
-                            'switch': '',
-                            'output': msg
-                        }
-                        module.exit_json(
-                            unreachable=False,
-                            failed=True,
-                            exception=msg,
-                            summary=results,
-                            task='L3 ZTP',
-                            msg='L3 ZTP failed',
-                            changed=False
-                        )
-                    ip_ipv6 = (ip_list[0] if subnet_ipv6 == '127' else ip_list[1])
-
-                lport = leaf_port[0]
-
-                cli = clicopy
-                cli += ' switch %s port-show port %s ' % (current_switch, lport)
-                cli += ' format rport no-show-headers '
-                rport = run_command(module, cli, task, msg).split()
-                rport = list(set(rport))
-                rport = rport[0]
-
-                if addr_type == 'ipv4' or addr_type == 'ipv4_ipv6':
-                    ip_ipv4 = str(ips[0])
+                if do_v6:
+                    ip_list = ipv6_links[spine_index]
+                    ip_ipv6 = (ip_list[0] if ipv6_127 else ip_list[1])
+
+                if do_v4:
+                    ip_ipv4 = str(ipaddress.IPv4Address(link_ips[spine_index][0]))
 
                 delete_trunk(module, spine, rport, current_switch, task, msg)
                 CHANGED_FLAG, res = create_interface(module, spine, ip_ipv4, ip_ipv6, rport, addr_type, CHANGED_FLAG, task, msg)
-                output += res
+                output.append(res)
 
-                leaf_port.remove(lport)
-                if addr_type == 'ipv6' or addr_type == 'ipv4_ipv6':
-                    ip_ipv6 = (ip_list[1] if subnet_ipv6 == '127' else ip_list[2])
+                if do_v6:
+                    ip_ipv6 = (ip_list[1] if ipv6_127 else ip_list[2])
 
-                if addr_type == 'ipv4' or addr_type == 'ipv4_ipv6':
-                    ip_ipv4 = str(ips[1])
+                if do_v4:
+                    ip_ipv4 = str(ipaddress.IPv4Address(link_ips[spine_index][1]))
 
                 delete_trunk(module, current_switch, lport, spine, task, msg)
                 CHANGED_FLAG, res = create_interface(module, current_switch, ip_ipv4, ip_ipv6, lport, addr_type, CHANGED_FLAG, task, msg)
-                output += res
-                count += 1
+                output.append(res)
 
         # Enable auto trunk on all switches.
-        modify_auto_trunk_setting(module, current_switch, 'enable', task, msg)
-        for spine in spine_list:
-            # Enable auto trunk.
-            modify_auto_trunk_setting(module, spine, 'enable', task, msg)
+        modify_auto_trunk_setting(module, trunk_switches, 'enable', task, msg)
 
-    return output
+    return ''.join(output)
 
 
 def main():
@@ -352,15 +356,18 @@ def main():
     results = []
     switch_list = module.params['pn_spine_list'] + module.params['pn_leaf_list']
 
-    for switch in switch_list:
-        replace_string = switch + ': '
-        for line in message_string.splitlines():
-            if replace_string in line:
-                json_msg = {
-                    'switch': switch,
-                    'output': (line.replace(replace_string, '')).strip()
-                }
-                results.append(json_msg)
+    # Lines carry '<switch>: ' somewhere in them, match all switches in one
+    # pass. Longest names first so a name never shadows a longer one.
+    switch_names = sorted(set(switch_list), key=len, reverse=True)
+    switch_re = re.compile('(%s): ' % '|'.join(re.escape(switch) for switch in switch_names))
+    for line in message_string.splitlines():
+        match = switch_re.search(line) if switch_names else None
+        if match:
+            json_msg = {
+                'switch': match.group(1),
+                'output': (line.replace(match.group(0), '')).strip()
+            }
+            results.append(json_msg)
 
     # Exit the module and return the required JSON.
     module.exit_json(
@@ -369,7 +376,7 @@ def main():
         summary=results,
         exception='',
         failed=False,
-        changed=True if True in CHANGED_FLAG else False,
+        changed=any(CHANGED_FLAG),
         task='Configure L3 ZTP'
     )
 